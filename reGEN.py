@@ -1,17 +1,322 @@
 
-import os, sys, json, re, traceback
+import os, sys, json, re, time, traceback, functools, multiprocessing, bisect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
 from pathlib import Path
 from urllib.request import urlopen
 from io import BytesIO
-from PIL import Image
+from PIL import Image, __version__ as PIL_VERSION
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 from PySide6.QtCore import Qt, QThread, Signal
 from PySide6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
-    QTextEdit, QFileDialog, QSpinBox, QProgressBar, QMessageBox
+    QTextEdit, QFileDialog, QSpinBox, QComboBox, QProgressBar, QMessageBox
 )
 from PySide6.QtGui import QFont, QColor, QPalette
 
 
+# ----------------------------
+# Name Matching
+# ----------------------------
+_RARITY_RE = re.compile(r'[#_\-\d]+$')  # rarity suffixes like #12, _12, -12
+_ALNUM_RE = re.compile(r'[^a-z0-9]')
+
+
+@functools.lru_cache(maxsize=None)
+def _normalize(text: str):
+    """Normalize text for matching (remove symbols, lowercase)."""
+    return _ALNUM_RE.sub('', _RARITY_RE.sub('', str(text)).strip().lower())
+
+
+class _PrefixTrie:
+    """Dict-of-dicts trie over normalized stems; each node keeps the first path inserted below it."""
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, stem, path):
+        node = self._root
+        for ch in stem:
+            node = node.setdefault(ch, {})
+            node.setdefault(None, path)
+
+    def first_with_prefix(self, prefix):
+        node = self._root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return None
+        return node.get(None)
+
+
+class _StemSet:
+    """Normalized stems of one folder (or the whole tree) and the first path seen for each."""
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = _PrefixTrie()
+        self._blob = ""
+        self._starts = []
+        self._paths = []
+
+    def add(self, stem, path):
+        if stem not in self._exact:
+            self._exact[stem] = path
+            self._trie.insert(stem, path)
+
+    def freeze(self):
+        """Join the stems into one NUL-separated string for C-level substring search."""
+        self._paths = list(self._exact.values())
+        self._starts, pos = [], 0
+        for stem in self._exact:
+            self._starts.append(pos)
+            pos += len(stem) + 1
+        self._blob = "\0".join(self._exact)
+
+    def match(self, tval):
+        """Exact stem first, then prefix, then substring match; first-seen stem wins on ties."""
+        path = self._exact.get(tval)
+        if path is None:
+            path = self._trie.first_with_prefix(tval)
+        if path is None:
+            # Stems are [a-z0-9] only, so a hit never spans the NUL separators.
+            pos = self._blob.find(tval)
+            if pos >= 0 and self._paths:
+                path = self._paths[bisect.bisect_right(self._starts, pos) - 1]
+        return path
+
+
+def _scandir_files(root):
+    """Recursively yield image DirEntries under root using cached scandir metadata."""
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scandir_files(entry.path)
+            elif entry.is_file() and entry.name.rpartition(".")[2].lower() in ("png", "jpg", "jpeg"):
+                yield entry
+
+
+_LAYER_CACHE_BYTES = 1 << 30  # default decoded-layer budget for a single LayerIndex
+
+
+class LayerIndex:
+    """Normalized lookup of layer files, plus per-process caches of resolved and decoded layers.
+
+    Built once in the worker thread and pickled into each compositing process.
+    Decoded layers are kept in an LRU bounded by cache_bytes (at least one layer).
+    """
+
+    def __init__(self, layer_dir, canvas_w, canvas_h, resample=Image.Resampling.BILINEAR,
+                 cache_bytes=_LAYER_CACHE_BYTES):
+        self.layer_dir = Path(layer_dir)
+        self.canvas_w = canvas_w
+        self.canvas_h = canvas_h
+        self.resample = resample
+        self.cache_bytes = cache_bytes
+        self._index = {}
+        self._index_flat = _StemSet()
+        self._path_cache = {}
+        self._layer_cache = OrderedDict()
+
+    def build(self):
+        """Scan the layer tree once and map normalized trait folders/stems to file paths."""
+        with os.scandir(self.layer_dir) as folders:
+            for folder in folders:
+                if not folder.is_dir():
+                    continue
+                files = self._index.setdefault(_normalize(folder.name), _StemSet())
+                with os.scandir(folder.path) as entries:
+                    for img_file in entries:
+                        name, dot, ext = img_file.name.rpartition(".")
+                        if dot and img_file.is_file() and ext.lower() in ("png", "jpg", "jpeg"):
+                            files.add(_normalize(name), img_file.path)
+
+        for img_file in _scandir_files(self.layer_dir):
+            self._index_flat.add(_normalize(img_file.name.rpartition(".")[0]), img_file.path)
+
+        for files in self._index.values():
+            files.freeze()
+        self._index_flat.freeze()
+        return self
+
+    def _resolve_path(self, ttype, tval):
+        """Find the layer file for normalized trait names, or None."""
+        # Search folders matching trait_type
+        for folder_norm, files in self._index.items():
+            if ttype in folder_norm:
+                img_file = files.match(tval)
+                if img_file is not None:
+                    return img_file
+
+        # Global fallback search
+        return self._index_flat.match(tval)
+
+    def load(self, trait_type, trait_value):
+        """Fuzzy match against rarity-numbered and inconsistent file names.
+
+        Returns (layer, opaque) with the layer decoded and resized to the canvas and
+        shared across NFTs, or None when nothing matches.
+        """
+        key = (_normalize(trait_type), _normalize(trait_value))
+        if key in self._path_cache:
+            img_file = self._path_cache[key]
+        else:
+            img_file = self._path_cache[key] = self._resolve_path(*key)
+
+        if img_file is None:
+            return None
+
+        layer = self._layer_cache.get(img_file)
+        if layer is not None:
+            self._layer_cache.move_to_end(img_file)
+            return layer
+
+        layer_img = Image.open(img_file).convert("RGBA")
+        if layer_img.size != (self.canvas_w, self.canvas_h):
+            layer_img = layer_img.resize((self.canvas_w, self.canvas_h), self.resample)
+        opaque = layer_img.getextrema()[3] == (255, 255)
+        layer = (layer_img, opaque)
+
+        max_layers = max(1, self.cache_bytes // (self.canvas_w * self.canvas_h * 4))
+        while len(self._layer_cache) >= max_layers:
+            self._layer_cache.popitem(last=False)
+        self._layer_cache[img_file] = layer
+        return layer
+
+
+# ----------------------------
+# Compositing (runs in worker processes)
+# ----------------------------
+_BATCH_SIZE = 8
+_IO_WORKERS = 2
+_CANVAS_SLOTS = _IO_WORKERS + 1  # one compositing while each I/O thread saves another
+_MEMORY_BUDGET = 2 << 30  # canvases + decoded layers, summed over all compositing processes
+_MIN_CACHED_LAYERS = 8  # roughly one NFT's worth, so a process does not thrash its cache
+
+_layers = None
+_out_dir = None
+_compress_level = 6
+_io_pool = None
+_stop_event = None
+_canvases = []
+_canvas_saves = []
+_canvas_size = None
+_canvas_box = None
+
+
+def _init_process(layers, out_dir, compress_level, stop_event):
+    global _layers, _out_dir, _compress_level, _io_pool, _stop_event, _canvas_size, _canvas_box
+    _layers = layers
+    _stop_event = stop_event
+    # The canvas size is fixed for the whole run; build the size/box tuples once.
+    _canvas_size = (layers.canvas_w, layers.canvas_h)
+    _canvas_box = (0, 0) + _canvas_size
+    _out_dir = Path(out_dir)
+    _compress_level = compress_level
+    _io_pool = ThreadPoolExecutor(max_workers=_IO_WORKERS)
+
+
+def _canvas(slot):
+    """Per-process RGBA canvas for a ring slot, allocated once and reused.
+
+    Blocks until the slot's previous save has finished reading the canvas.
+    """
+    while len(_canvases) <= slot:
+        _canvases.append(Image.new("RGBA", _canvas_size, (0, 0, 0, 0)))
+        _canvas_saves.append(None)
+    if _canvas_saves[slot] is not None:
+        wait([_canvas_saves[slot]])
+        _canvas_saves[slot] = None
+    return _canvases[slot]
+
+
+def _composite_one(meta_path, meta, base, logs):
+    """Flatten the layers for one NFT into base.
+
+    Returns (base, covered), where covered means an opaque layer was drawn, or None to skip it.
+    """
+    attributes = meta.get("attributes", [])
+    if not attributes:
+        logs.append(f"[WARN] {meta_path.name}: no attributes found.")
+        return None
+
+    empty, covered = True, False
+
+    for att in attributes:
+        ttype = att.get("trait_type", "").strip()
+        tval = att.get("value", "").strip()
+        if not ttype or not tval:
+            continue
+        layer = _layers.load(ttype, tval)
+        if layer is None:
+            logs.append(f"[MISS] {ttype}/{tval}")
+            continue
+        layer_img, opaque = layer
+        if empty or opaque:
+            # Over an empty canvas, or for a fully opaque layer, the layer is the result; skip the blend.
+            base.paste(layer_img, (0, 0))
+            empty = False
+            covered = covered or opaque
+        else:
+            base.alpha_composite(layer_img)
+
+    if empty:
+        base.paste((0, 0, 0, 0), _canvas_box)
+    return base, covered
+
+
+def _save_png(base, out_path, covered):
+    """Encode one NFT; drops the alpha channel when nothing in it is transparent."""
+    if covered or base.getextrema()[3] == (255, 255):
+        # Once an opaque layer is drawn, over-compositing keeps every pixel opaque.
+        base = base.convert("RGB")
+    base.save(out_path, format="PNG", compress_level=_compress_level)
+
+
+def _process_batch(batch):
+    """Rebuild a batch of metadata files; returns the log lines for it.
+
+    PNG encoding runs on a small thread pool so the next NFT composites while
+    the previous one is still being written. Canvases rotate through
+    _CANVAS_SLOTS slots; the batch waits for its saves before returning.
+    Files not yet started when the run is stopped are skipped.
+    """
+    pending = []
+    for i, meta_path in enumerate(batch):
+        if _stop_event.is_set():
+            break
+        logs, saved = [], None
+        slot = i % _CANVAS_SLOTS
+        try:
+            meta = _json_loads(meta_path.read_bytes())
+            result = _composite_one(meta_path, meta, _canvas(slot), logs)
+            if result is not None:
+                out_path = _out_dir / f"{meta_path.stem or meta_path.name}.png"
+                base, covered = result
+                saved = _canvas_saves[slot] = _io_pool.submit(_save_png, base, out_path, covered)
+        except (json.JSONDecodeError, UnicodeDecodeError):  # orjson's error subclasses JSONDecodeError
+            logs.append(f"[SKIP] invalid json {meta_path.name}")
+        except Exception as e:
+            logs.append(f"[ERR] {meta_path.name}: {e}")
+            traceback.print_exc()
+        pending.append((meta_path, logs, saved))
+
+    batch_logs = []
+    for meta_path, logs, saved in pending:
+        if saved is not None:
+            try:
+                saved.result()
+                logs.append(f"[OK] Saved {meta_path.stem or meta_path.name}.png")
+            except Exception as e:
+                logs.append(f"[ERR] {meta_path.name}: {e}")
+        batch_logs.extend(logs)
+    return batch_logs
+
+
 # ----------------------------
 # Worker Thread
 # ----------------------------
@@ -20,103 +325,101 @@ class RegenWorker(QThread):
     progress = Signal(int)
     finished = Signal()
 
-    def __init__(self, json_dir, layer_dir, out_dir, canvas_w, canvas_h):
+    def __init__(self, json_dir, layer_dir, out_dir, canvas_w, canvas_h, compress_level=1,
+                 resample=Image.Resampling.BILINEAR):
         super().__init__()
         self.json_dir = Path(json_dir)
         self.layer_dir = Path(layer_dir)
         self.out_dir = Path(out_dir)
         self.canvas_w = canvas_w
         self.canvas_h = canvas_h
+        self.compress_level = compress_level
+        self.resample = resample
         self._stop = False
+        self._stop_event = None
+        self._log_buf = []
+        self._log_flushed = 0.0
 
     def stop(self):
         self._stop = True
+        if self._stop_event is not None:
+            self._stop_event.set()
 
-    def _normalize(self, text: str):
-        """Normalize text for matching (remove symbols, lowercase)."""
-        text = re.sub(r'[#_\-\d]+$', '', str(text))  # remove rarity suffixes like #12, _12, -12
-        text = re.sub(r'[^a-z0-9]', '', text.strip().lower())
-        return text
+    def _queue_log(self, msgs):
+        """Coalesce log lines into one signal per 64 lines or 100ms to spare the GUI thread.
 
-    def _load_layer_image(self, trait_type, trait_value):
-        """Fuzzy match against rarity-numbered and inconsistent file names."""
-        ttype = self._normalize(trait_type)
-        tval = self._normalize(trait_value)
+        run() also flushes every 100ms while waiting on a batch, so nothing sits in the buffer longer.
+        """
+        self._log_buf.extend(msgs)
+        if len(self._log_buf) >= 64 or time.monotonic() - self._log_flushed >= 0.1:
+            self._flush_log()
 
-        # Search folders matching trait_type
-        for folder in self.layer_dir.iterdir():
-            if folder.is_dir() and ttype in self._normalize(folder.name):
-                for img_file in folder.iterdir():
-                    if img_file.suffix.lower() in (".png", ".jpg", ".jpeg"):
-                        stem_norm = self._normalize(img_file.stem)
-                        if tval == stem_norm or tval in stem_norm:
-                            return Image.open(img_file).convert("RGBA")
-
-        # Global fallback search
-        for img_file in self.layer_dir.rglob("*"):
-            if img_file.suffix.lower() in (".png", ".jpg", ".jpeg"):
-                stem_norm = self._normalize(img_file.stem)
-                if tval == stem_norm or tval in stem_norm:
-                    return Image.open(img_file).convert("RGBA")
-
-        self.log.emit(f"[MISS] {trait_type}/{trait_value}")
-        return None
+    def _flush_log(self):
+        if self._log_buf:
+            self.log.emit("\n".join(self._log_buf))
+            self._log_buf.clear()
+        self._log_flushed = time.monotonic()
 
     def run(self):
         try:
-            all_files = [f for f in self.json_dir.iterdir() if f.is_file()]
-            json_files = []
-            for f in all_files:
-                try:
-                    with open(f, "r") as jf:
-                        json.load(jf)
-                    json_files.append(f)
-                except Exception:
-                    continue
+            with os.scandir(self.json_dir) as entries:
+                json_files = [Path(f.path) for f in entries if f.is_file()]
 
             total = len(json_files)
             if not total:
-                self.log.emit("[!] No valid metadata files found.")
+                self.log.emit("[!] No metadata files found.")
                 return
 
-            self.out_dir.mkdir(parents=True, exist_ok=True)
-
-            for idx, meta_path in enumerate(json_files, start=1):
-                if self._stop:
-                    self.log.emit("[!] Stopped by user.")
-                    break
-
-                try:
-                    with open(meta_path, "r") as f:
-                        meta = json.load(f)
+            if "post" not in PIL_VERSION:
+                self.log.emit("[HINT] Install pillow-simd for faster resize/compositing.")
 
-                    attributes = meta.get("attributes", [])
-                    if not attributes:
-                        self.log.emit(f"[WARN] {meta_path.name}: no attributes found.")
-                        continue
-
-                    base = Image.new("RGBA", (self.canvas_w, self.canvas_h), (0, 0, 0, 0))
-
-                    for att in attributes:
-                        ttype = att.get("trait_type", "").strip()
-                        tval = att.get("value", "").strip()
-                        if not ttype or not tval:
-                            continue
-                        layer_img = self._load_layer_image(ttype, tval)
-                        if layer_img is None:
-                            continue
-                        layer_img = layer_img.resize((self.canvas_w, self.canvas_h), Image.LANCZOS)
-                        base.alpha_composite(layer_img)
-
-                    out_path = self.out_dir / f"{meta_path.stem or meta_path.name}.png"
-                    base.save(out_path)
-                    self.log.emit(f"[OK] Saved {out_path.name}")
-
-                except Exception as e:
-                    self.log.emit(f"[ERR] {meta_path.name}: {e}")
-                    traceback.print_exc()
+            self.out_dir.mkdir(parents=True, exist_ok=True)
 
-                self.progress.emit(int(idx / total * 100))
+            # Every process holds its own canvases and layer cache, so size the pool to the
+            # memory budget rather than the core count and split the cache budget between them.
+            batches = [json_files[i:i + _BATCH_SIZE] for i in range(0, total, _BATCH_SIZE)]
+            canvas_bytes = self.canvas_w * self.canvas_h * 4
+            fixed_bytes = canvas_bytes * (_CANVAS_SLOTS + _IO_WORKERS)  # canvases + RGB copies being saved
+            workers = max(1, min(
+                os.cpu_count() or 1,
+                len(batches),
+                _MEMORY_BUDGET // (fixed_bytes + canvas_bytes * _MIN_CACHED_LAYERS),
+            ))
+            cache_bytes = max(canvas_bytes, _MEMORY_BUDGET // workers - fixed_bytes)
+            layers = LayerIndex(
+                self.layer_dir, self.canvas_w, self.canvas_h, self.resample, cache_bytes
+            ).build()
+
+            # spawn, not fork: forking a process that is running Qt threads is unsafe
+            ctx = multiprocessing.get_context("spawn")
+            self._stop_event = ctx.Event()
+            if self._stop:
+                self._stop_event.set()
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=ctx,
+                initializer=_init_process,
+                initargs=(layers, str(self.out_dir), self.compress_level, self._stop_event),
+            )
+            try:
+                done = 0
+                futures = [pool.submit(_process_batch, batch) for batch in batches]
+                for batch, future in zip(batches, futures):
+                    while True:
+                        try:
+                            logs = future.result(timeout=0.1)
+                            break
+                        except FutureTimeout:
+                            self._flush_log()
+                    self._queue_log(logs)
+                    done += len(batch)
+                    self.progress.emit(int(done / total * 100))
+                    if self._stop:
+                        self._queue_log(["[!] Stopped by user."])
+                        break
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+                self._flush_log()
 
             self.log.emit("[DONE] reGENERATION complete.")
         except Exception as e:
@@ -201,6 +504,17 @@ class RegenApp(QWidget):
         size_row.addWidget(QLabel("Canvas Height:"))
         self.h_spin = QSpinBox(); self.h_spin.setRange(64, 8192); self.h_spin.setValue(1000)
         size_row.addWidget(self.h_spin)
+        size_row.addWidget(QLabel("PNG Compression:"))
+        self.zlib_spin = QSpinBox(); self.zlib_spin.setRange(0, 9); self.zlib_spin.setValue(1)
+        self.zlib_spin.setToolTip("0-9: higher is smaller but slower to save")
+        size_row.addWidget(self.zlib_spin)
+        size_row.addWidget(QLabel("Resample:"))
+        self.resample_combo = QComboBox()
+        for name in ("NEAREST", "BILINEAR", "BICUBIC", "LANCZOS"):
+            self.resample_combo.addItem(name, Image.Resampling[name])
+        self.resample_combo.setCurrentText("BILINEAR")
+        self.resample_combo.setToolTip("Filter for layers that need scaling to the canvas size")
+        size_row.addWidget(self.resample_combo)
 
         # Control buttons
         ctrl_row = QHBoxLayout()
@@ -248,7 +562,10 @@ class RegenApp(QWidget):
 
         w, h = self.w_spin.value(), self.h_spin.value()
 
-        self.worker = RegenWorker(json_dir, layer_dir, out_dir, w, h)
+        self.worker = RegenWorker(
+            json_dir, layer_dir, out_dir, w, h,
+            self.zlib_spin.value(), self.resample_combo.currentData()
+        )
         self.worker.log.connect(self._append_log)
         self.worker.progress.connect(self.progress.setValue)
         self.worker.finished.connect(self._on_finished)
@@ -271,12 +588,14 @@ class RegenApp(QWidget):
             reply = QMessageBox.question(
                 self,
                 "Confirm Exit",
-                "reGENERATOR is still running. Stop and exit?",
+                "reGENERATOR is still running. Stop and exit?\n"
+                "Images already being composited will finish saving first.",
                 QMessageBox.Yes | QMessageBox.No
             )
             if reply == QMessageBox.Yes:
                 self.worker.stop()
-                self.worker.wait(2000)
+                # Destroying a running QThread aborts; wait for the pool to wind down.
+                self.worker.wait()
                 event.accept()
             else:
                 event.ignore()
@@ -288,6 +607,7 @@ class RegenApp(QWidget):
 # Entry Point
 # ----------------------------
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     win = RegenApp()
     win.show()